@@ -1,8 +1,10 @@
 import configparser
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import os
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
-from pyspark.sql.types import DateType, TimestampType, FloatType
+from pyspark.sql.types import StructType, StructField, StringType, DoubleType, LongType, DateType, TimestampType, FloatType
+from pyspark.sql.window import Window
 import pyspark.sql.functions as F
 import boto3
 import botocore
@@ -15,12 +17,55 @@ aws_access_key_secret = config.get("AWS", 'SECRET_ACCESS_KEY')
 aws_access_input_bucket = config.get("AWS", 'INPUT_BUCKET')
 aws_access_output_bucket = config.get("AWS", 'OUTPUT_BUCKET')
 
+# row counts are a full pass over each table so they are only printed when requested
+VERBOSE = os.getenv("ETL_VERBOSE") == "1"
+
 s3 = boto3.resource(
     "s3", region_name=aws_region,
     aws_access_key_id=aws_access_key_id,
     aws_secret_access_key=aws_access_key_secret
 )
 
+# explicit schemas of the source files so spark does not scan them to infer the types
+song_schema = StructType([
+    StructField("song_id", StringType()),
+    StructField("title", StringType()),
+    StructField("artist_id", StringType()),
+    StructField("artist_name", StringType()),
+    StructField("artist_location", StringType()),
+    StructField("artist_latitude", DoubleType()),
+    StructField("artist_longitude", DoubleType()),
+    StructField("year", LongType()),
+    StructField("duration", DoubleType()),
+    StructField("num_songs", LongType())
+])
+
+# only the log fields used by the users, time and songplays tables are parsed
+log_schema = StructType([
+    StructField("artist", StringType()),
+    StructField("firstName", StringType()),
+    StructField("gender", StringType()),
+    StructField("lastName", StringType()),
+    StructField("length", DoubleType()),
+    StructField("level", StringType()),
+    StructField("location", StringType()),
+    StructField("page", StringType()),
+    StructField("sessionId", LongType()),
+    StructField("song", StringType()),
+    StructField("ts", LongType()),
+    StructField("userAgent", StringType()),
+    StructField("userId", StringType())
+])
+
+# schema of the songs table, partition discovery would otherwise read the year partition column as integer
+songs_table_schema = StructType([
+    StructField("song_id", StringType()),
+    StructField("title", StringType()),
+    StructField("artist_id", StringType()),
+    StructField("year", LongType()),
+    StructField("duration", DoubleType())
+])
+
 def create_spark_session():
     """
         This function creates the Spark Session that is used for processing the Data Lake
@@ -36,164 +81,282 @@ def create_spark_session():
         .config("spark.hadoop.fs.s3a.access.key", aws_access_key_id) \
         .config("spark.hadoop.fs.s3a.secret.key", aws_access_key_secret) \
         .config("spark.hadoop.fs.s3a.connection.maximum", "100000") \
+        .config("spark.hadoop.fs.s3a.fast.upload", "true") \
+        .config("spark.sql.autoBroadcastJoinThreshold", str(256 * 1024 * 1024)) \
+        .config("spark.sql.adaptive.enabled", "true") \
+        .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+        .config("spark.sql.adaptive.skewJoin.enabled", "true") \
+        .config("spark.sql.adaptive.localShuffleReader.enabled", "true") \
+        .config("spark.sql.adaptive.advisoryPartitionSizeInBytes", "128m") \
+        .config("spark.sql.shuffle.partitions", str((os.cpu_count() or 1) * 4)) \
+        .config("spark.shuffle.compress", "true") \
+        .config("spark.shuffle.file.buffer", "64k") \
+        .config("spark.hadoop.mapreduce.fileoutputcommitter.algorithm.version", "2") \
+        .config("spark.sql.parquet.compression.codec", "zstd") \
+        .config("spark.scheduler.mode", "FAIR") \
         .getOrCreate()
 
     return spark
 
 
-def process_song_data(spark, input_data, output_data):
+def path_exists(spark, path):
     """
-        This function takes in the input_data path to obtain the source files (S3 or local).
-        Performs ETL to generate the songs and artists dimension tables
+        This function checks whether the path exists on the file system of the path (S3 or local)
     """
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration()).exists(hadoop_path)
 
-    # get filepath to song data file
-    if input_data.startswith("s3a://"):
-        # get objects to process from S3
-        song_data = [
-           f"{input_data}/{song_object.key}" for song_object in s3.Bucket(aws_access_input_bucket).objects.filter(Prefix="song_data") if song_object.key.endswith(".json")
-        ]
-    else:
-        # get objects to process from local     
-        song_data = f"{input_data}/song_data/*/*/*/*.json"
+def delete_path(spark, path):
+    """
+        This function recursively deletes the path from the file system of the path (S3 or local)
+    """
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration()).delete(hadoop_path, True)
 
-    # read song data file
-    df = spark.read.json(song_data)
+def stage_song_batch(df, batch_id, output_data):
+    """
+        This function takes in a micro-batch of song data and stages its songs and artists under
+        the batch_id, so a replayed batch overwrites its own output instead of adding to it
+    """
 
-    # extract columns to create songs table
-    songs_table = df.select(
-        df.song_id, df.title, df.artist_id, df.year, df.duration        
-    ).dropDuplicates()
-    
-    # write songs table to parquet files partitioned by year and artist
-    print(f"[INFO] persisting for {songs_table.count()} songs")
-    print("[INFO] songs_table schema:")
-    songs_table.printSchema()    
+    # the batch is the source for both the songs and artists
+    df = df.persist(StorageLevel.MEMORY_AND_DISK)
 
-    songs_table.write.parquet(
-        f"{output_data}/songs", 
-        partitionBy=['year', 'artist_id'],
+    # extract columns to stage for the songs table
+    df.select(
+        df.song_id, df.title, df.artist_id, df.year, df.duration        
+    ).distinct().write.parquet(
+        f"{output_data}/_staging/songs/batch_id={batch_id}",
         mode='overwrite'
     )
 
-    # extract columns to create artists table
-    artists_table = df.select(
+    # extract columns to stage for the artists table
+    df.select(
         df.artist_id,
         df.artist_name.alias("name"), 
         df.artist_location.alias("location"), 
         df.artist_latitude.alias("latitude"), 
         df.artist_longitude.alias("longitude")
-    ).dropDuplicates()
-    
-    # write artists table to parquet files
-    print(f"[INFO] persisting for {artists_table.count()} artists")
+    ).distinct().write.parquet(
+        f"{output_data}/_staging/artists/batch_id={batch_id}",
+        mode='overwrite'
+    )
+
+    df.unpersist()
+
+def get_new_rows(spark, staging_path, table_path, keys):
+    """
+        This function reads the rows staged by the micro-batches and keeps one row per distinct keys
+        for the keys that are not in the table yet. The keys are compared null-safe as the artist columns can be null
+    """
+    new_rows = spark.read.parquet(staging_path).drop("batch_id").dropDuplicates(keys)
+    if path_exists(spark, table_path):
+        table_keys = spark.read.parquet(table_path).select(keys)
+        new_rows = new_rows.join(
+            table_keys, [new_rows[key].eqNullSafe(table_keys[key]) for key in keys], "left_anti"
+        )
+
+    return new_rows
+
+def process_song_data(spark, input_data, output_data):
+    """
+        This function takes in the input_data path to obtain the source files (S3 or local).
+        Performs ETL on the song files not processed by a previous run to generate the songs and artists dimension tables.
+        Returns the persisted songs and artists tables for use by process_songplays_data
+    """
+
+    # get filepath to song data file, the files are discovered by spark from the glob (S3 or local)
+    song_data = f"{input_data}/song_data/*/*/*/*.json"
+
+    # stage the new song data files, the checkpoint records which files have already been processed
+    song_query = spark.readStream \
+        .schema(song_schema) \
+        .option("maxFilesPerTrigger", 1000) \
+        .json(song_data) \
+        .writeStream \
+        .trigger(availableNow=True) \
+        .option("checkpointLocation", f"{output_data}/_checkpoints/songs") \
+        .foreachBatch(lambda df, batch_id: stage_song_batch(df, batch_id, output_data)) \
+        .start()
+    song_query.awaitTermination()
+
+    # append the staged rows once per run, skipping keys already in the tables so they stay unique.
+    # the staging is only removed after both appends so an interrupted run is completed by the next one
+    if path_exists(spark, f"{output_data}/_staging"):
+        new_songs = get_new_rows(spark, f"{output_data}/_staging/songs", f"{output_data}/songs", ["song_id"])
+
+        # write songs table to parquet files partitioned by year, artist_id has too many values to partition on
+        new_songs.repartition("year").write.parquet(
+            f"{output_data}/songs", 
+            partitionBy=['year'],
+            mode='append'
+        )
+
+        # an artist_id can come with several names or locations, every variant is kept for the songplays join
+        new_artists = get_new_rows(
+            spark, f"{output_data}/_staging/artists", f"{output_data}/artists",
+            ["artist_id", "name", "location", "latitude", "longitude"]
+        )
+
+        # write artists table to parquet files
+        new_artists.repartition(4).write.parquet(
+            f"{output_data}/artists",
+            mode='append'
+        )
+
+        delete_path(spark, f"{output_data}/_staging")
+
+    # read in the complete tables, with the incremental load only the tables on disk hold the rows of previous runs
+    songs_table = spark.read.schema(songs_table_schema).parquet(
+        f"{output_data}/songs"
+    ).select(songs_table_schema.fieldNames()).persist(StorageLevel.MEMORY_AND_DISK)
+    artists_table = spark.read.parquet(f"{output_data}/artists").persist(StorageLevel.MEMORY_AND_DISK)
+
+    if VERBOSE:
+        print(f"[INFO] persisted {songs_table.count()} songs")
+    print("[INFO] songs_table schema:")
+    songs_table.printSchema()
+
+    if VERBOSE:
+        print(f"[INFO] persisted {artists_table.count()} artists")
     print("[INFO] artists_table schema:")
-    artists_table.printSchema()    
+    artists_table.printSchema()
 
-    artists_table.write.parquet(
-        f"{output_data}/artists",
-        mode='overwrite'
-    )    
+    return songs_table, artists_table
 
 def process_log_data(spark, input_data, output_data):
     """
         This function takes in the input_data path to obtain the source files (S3 or local).
-        Performs ETL to generate the users, times dimension tables and songplays fact table
+        Performs ETL to generate the users and times dimension tables.
+        Returns the persisted song play logs for use by process_songplays_data
     """
 
+    # get filepath to log data file, the files are discovered by spark from the glob
     if input_data.startswith("s3a://"):
         # get objects to process from S3
-        log_data = [
-           f"{input_data}/{log_object.key}" for log_object in s3.Bucket(aws_access_input_bucket).objects.filter(Prefix="log_data") if log_object.key.endswith(".json")
-        ]
+        log_data = f"{input_data}/log_data/*/*/*.json"
     else:
         # get objects to process from local
         log_data = f"{input_data}/log-data/*.json" 
 
     # read log data file
-    df = spark.read.json(log_data)
+    df = spark.read.schema(log_schema).json(log_data)
     
     # filter by actions for song plays
     df = df.where(df.page == "NextSong")
 
+    # create datetime column from original timestamp column
+    df = df.withColumn("start_time", (df.ts / 1000).cast(TimestampType()))
+
+    # derive the partition columns once for both the time and songplays tables
+    df = df.withColumn("year", F.year(df.start_time)).withColumn("month", F.month(df.start_time))
+
+    # keep the filtered logs around as they are the source for the users, time and songplays tables
+    df = df.persist(StorageLevel.MEMORY_AND_DISK)
+
     # extract columns for users table    
-    users_table = df.sort('ts', ascending=False).select(
+    # keep the latest log of each user so the level is the current one
+    latest_log = Window.partitionBy(df.userId).orderBy(df.ts.desc())
+    users_table = df.withColumn(
+        "row_number", F.row_number().over(latest_log)
+    ).where(F.col("row_number") == 1).select(
         df.userId.alias('user_id'),
         df.firstName.alias('first_name'),
         df.lastName.alias('last_name'),
         df.gender,
         df.level
-    ).dropDuplicates(['user_id', 'first_name', 'last_name', 'gender'])
+    )
     
     # write users table to parquet files
-    print(f"[INFO] persisting for {users_table.count()} users")
+    if VERBOSE:
+        print(f"[INFO] persisting for {users_table.count()} users")
     print("[INFO] users_table schema:")
     users_table.printSchema()    
 
-    users_table.write.parquet(f"{output_data}/users", mode='overwrite')
-
-    # create datetime column from original timestamp column
-    get_datetime = F.udf(lambda epoch: datetime.fromtimestamp(epoch / 1000.0), TimestampType())
-    df = df.withColumn("start_time", get_datetime(df.ts))
+    users_table.repartition(4).write.parquet(f"{output_data}/users", mode='overwrite')
 
     # extract columns to create time table
-    time_table = df.select(
-        df.start_time.alias('start_time'),
-        F.hour(df.start_time).alias('hour'),
-        F.dayofmonth(df.start_time).alias('day'),
-        F.weekofyear(df.start_time).alias('week'),
-        F.month(df.start_time).alias('month'),
-        F.year(df.start_time).alias('year'),
-        F.date_format(df.start_time, 'E').alias('weekday')
+    time_table = df.selectExpr(
+        "start_time",
+        "hour(start_time) AS hour",
+        "dayofmonth(start_time) AS day",
+        "weekofyear(start_time) AS week",
+        "month",
+        "year",
+        "date_format(start_time, 'E') AS weekday"
     )
     
     # write time table to parquet files partitioned by year and month
-    print(f"[INFO] persisting for {time_table.count()} times")
+    if VERBOSE:
+        print(f"[INFO] persisting for {time_table.count()} times")
     print("[INFO] time_table schema:")
     time_table.printSchema()
 
-    time_table.write.parquet(
+    time_table.repartition("year", "month").write.parquet(
             f"{output_data}/times",
             partitionBy=['year', 'month'],
             mode='overwrite'
     )
 
-    # read in song data to use for songplays table
-    song_df = spark.read.parquet(f"{output_data}/songs")
-    artist_df = spark.read.parquet(f"{output_data}/artists")
+    return df
 
-    # extract columns from joined song and log datasets to create songplays table 
-    songplays_table = df.join(
-        artist_df, df.artist == artist_df.name, "inner"
+def process_songplays_data(output_data, df, song_df, artist_df):
+    """
+        This function takes in the song play logs returned by process_log_data and the songs and
+        artists tables returned by process_song_data. Performs ETL to generate the songplays fact table
+    """
+
+    # pre-join the songs and artists dimensions, only keeping the columns used by the songplays table
+    song_artist_df = song_df.select(
+        "song_id", "artist_id", "title", "duration"
     ).join(
-        song_df, [
-            artist_df.artist_id == song_df.artist_id,
-            df.song == song_df.title,
-            df.length == song_df.duration
+        artist_df.select("artist_id", "name"), "artist_id", "inner"
+    )
+    log_df = df.select(
+        "start_time", "userId", "level", "sessionId", "location", "userAgent",
+        "song", "artist", "length", "year", "month"
+    )
+
+    # extract columns from joined song and log datasets to create songplays table 
+    # the songs and artists dimension is small, broadcast it to avoid shuffling the logs
+    songplays_table = log_df.join(
+        F.broadcast(song_artist_df), [
+            log_df.song == song_artist_df.title,
+            log_df.artist == song_artist_df.name,
+            log_df.length == song_artist_df.duration
         ], "inner"
     ).select(
-        df.start_time,
-        df.userId.alias("user_id"),
-        df.level,
-        song_df.song_id,
-        artist_df.artist_id,
-        df.sessionId.alias("session_id"),
-        df.location,
-        df.userAgent.alias("user_agent"),
-        F.year(df.start_time).alias('year'),
-        F.month(df.start_time).alias('month')
+        log_df.start_time,
+        log_df.userId.alias("user_id"),
+        log_df.level,
+        song_artist_df.song_id,
+        song_artist_df.artist_id,
+        log_df.sessionId.alias("session_id"),
+        log_df.location,
+        log_df.userAgent.alias("user_agent"),
+        log_df.year,
+        log_df.month
     )
 
     # write songplays table to parquet files partitioned by year and month
-    print(f"[INFO] persisting for {songplays_table.count()} songplays")
+    if VERBOSE:
+        print(f"[INFO] persisting for {songplays_table.count()} songplays")
     print("[INFO] songplays_table schema:")
     songplays_table.printSchema()
 
-    songplays_table.write.parquet(
+    songplays_table.repartition("year", "month").write.parquet(
             f"{output_data}/songplays",
             partitionBy=['year', 'month'],
             mode='overwrite'
-    )    
+    )
+
+def run_in_pool(spark, pool, func, *args):
+    """
+        This function runs func in its own FAIR scheduler pool so that ETL methods running
+        concurrently from different threads share the cluster instead of queueing behind each other
+    """
+    spark.sparkContext.setLocalProperty("spark.scheduler.pool", pool)
+    return func(*args)
 
 def main():
     """
@@ -218,8 +381,17 @@ def main():
     # input_data = f"s3a://{aws_access_input_bucket}"
     # output_data = f"s3a://{aws_access_output_bucket}/dend-p4"
  
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    # the songs/artists and users/times tables are independent, only songplays needs both
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        song_future = executor.submit(run_in_pool, spark, "song_data", process_song_data, spark, input_data, output_data)
+        log_future = executor.submit(run_in_pool, spark, "log_data", process_log_data, spark, input_data, output_data)
+        songs_table, artists_table = song_future.result()
+        log_df = log_future.result()
+
+    process_songplays_data(output_data, log_df, songs_table, artists_table)
+    songs_table.unpersist()
+    artists_table.unpersist()
+    log_df.unpersist()
     spark.stop()
 
 if __name__ == "__main__":